@@ -1,7 +1,18 @@
 import streamlit as st
 import pandas as pd
-import os
-from datetime import datetime
+
+from storage import (
+    assign_voucher,
+    clear_user_caches,
+    clear_voucher_caches,
+    get_upload_executor,
+    init_db,
+    load_authorized_users,
+    mapping_stats,
+    replace_authorized_users,
+    replace_vouchers,
+    voucher_counts,
+)
 
 # Set page config
 st.set_page_config(
@@ -10,101 +21,45 @@ st.set_page_config(
     layout="centered"
 )
 
-# Initialize session state
-if 'initialized' not in st.session_state:
-    st.session_state.initialized = True
-    if not os.path.exists('data'):
-        os.makedirs('data')
-
-    # Initialize vouchers.csv if it doesn't exist
-    if not os.path.exists('data/vouchers.csv'):
-        pd.DataFrame(columns=['voucher_code', 'assigned']).to_csv('data/vouchers.csv', index=False)
-
-    # Initialize mappings.csv if it doesn't exist
-    if not os.path.exists('data/mappings.csv'):
-        pd.DataFrame(columns=['timestamp', 'full_name', 'voucher_code']).to_csv('data/mappings.csv', index=False)
-
-    # Initialize authorized_users.csv if it doesn't exist
-    if not os.path.exists('data/authorized_users.csv'):
-        pd.DataFrame(columns=['full_name']).to_csv('data/authorized_users.csv', index=False)
-
-def load_vouchers():
-    """Load vouchers from CSV file"""
-    try:
-        return pd.read_csv('data/vouchers.csv')
-    except:
-        return pd.DataFrame(columns=['voucher_code', 'assigned'])
-
-def load_mappings():
-    """Load user-voucher mappings from CSV file"""
-    try:
-        return pd.read_csv('data/mappings.csv')
-    except:
-        return pd.DataFrame(columns=['timestamp', 'full_name', 'voucher_code'])
-
-def load_authorized_users():
-    """Load authorized users from CSV file"""
-    try:
-        return pd.read_csv('data/authorized_users.csv')
-    except:
-        return pd.DataFrame(columns=['full_name'])
-
-def is_user_authorized(full_name):
-    """Check if a user is authorized to receive a voucher"""
-    authorized_users = load_authorized_users()
-    # Convert full name to lowercase for case-insensitive comparison
-    full_name_lower = full_name.lower()
-
-    # Check if any part of the user's name matches an authorized user's name
-    for auth_name in authorized_users['full_name']:
-        auth_name_lower = str(auth_name).lower()
-        # Split names into parts and check if any part matches
-        user_name_parts = full_name_lower.split()
-        auth_name_parts = auth_name_lower.split()
-
-        # Check for any matching parts between the names
-        if any(part in auth_name_parts for part in user_name_parts):
-            return True
-
-    return False
-
-def assign_voucher(full_name):
-    """Assign a voucher to a user"""
-    # First check if user is authorized
-    if not is_user_authorized(full_name):
-        return False, "You are not authorized to receive a voucher. Please contact the administrator."
-
-    vouchers_df = load_vouchers()
-    mappings_df = load_mappings()
-
-    # Check if user already has a voucher
-    existing_mapping = mappings_df[mappings_df['full_name'] == full_name]
-    if len(existing_mapping) > 0:
-        return True, existing_mapping.iloc[0]['voucher_code']
-
-    # Check if there are available vouchers
-    available_vouchers = vouchers_df[vouchers_df['assigned'] == False]
-
-    if len(available_vouchers) == 0:
-        return False, "No vouchers available"
-
-    # Get the first available voucher
-    voucher_code = available_vouchers.iloc[0]['voucher_code']
-
-    # Mark voucher as assigned
-    vouchers_df.loc[vouchers_df['voucher_code'] == voucher_code, 'assigned'] = True
-    vouchers_df.to_csv('data/vouchers.csv', index=False)
-
-    # Record the mapping
-    new_mapping = pd.DataFrame({
-        'timestamp': [datetime.now().strftime("%Y-%m-%d %H:%M:%S")],
-        'full_name': [full_name],
-        'voucher_code': [voucher_code]
-    })
-    mappings_df = pd.concat([mappings_df, new_mapping], ignore_index=True)
-    mappings_df.to_csv('data/mappings.csv', index=False)
-
-    return True, voucher_code
+# Create the database on first start
+init_db()
+
+def new_upload(key, uploaded_file):
+    """Start tracking a newly uploaded file, or return None if it was already handled"""
+    # Uploaded files stay in the widget across reruns; only save each one once
+    upload = st.session_state.get(key)
+    if upload is not None and upload['file_id'] == uploaded_file.file_id:
+        return None
+    upload = {'file_id': uploaded_file.file_id, 'future': None, 'error': None, 'message': None, 'clear_caches': None}
+    st.session_state[key] = upload
+    return upload
+
+@st.fragment(run_every=1)
+def poll_upload_save(key):
+    """Show a running upload save, rerunning the page once it finishes"""
+    if not st.session_state[key]['future'].done():
+        st.status("Saving uploaded file...", state="running")
+    else:
+        # Rerun the whole page so the statistics pick up the new data
+        st.rerun()
+
+def show_upload_status(key):
+    """Report on the background save of an admin upload"""
+    upload = st.session_state[key]
+    if upload['error'] is not None:
+        st.error(upload['error'])
+    elif not upload['future'].done():
+        # Only poll while the save is still running
+        poll_upload_save(key)
+    elif upload['future'].exception() is not None:
+        st.error(f"Error uploading file: {str(upload['future'].exception())}")
+    else:
+        st.success(upload['message'])
+        # The save clears the caches from the worker thread, but a page run
+        # that was reading at the time may have cached the old data again
+        if upload['clear_caches'] is not None:
+            upload['clear_caches']()
+            upload['clear_caches'] = None
 
 # Initialize admin password in session state
 if 'admin_password' not in st.session_state:
@@ -130,55 +85,75 @@ if is_admin:
     with admin_tab1:
         uploaded_vouchers = st.file_uploader("Upload CSV file with voucher codes", type=['csv'], key="voucher_uploader")
         if uploaded_vouchers is not None:
-            try:
-                new_vouchers = pd.read_csv(uploaded_vouchers)
-                if 'voucher_code' not in new_vouchers.columns:
-                    st.error("CSV must contain a 'voucher_code' column")
-                else:
-                    new_vouchers['assigned'] = False
-                    new_vouchers.to_csv('data/vouchers.csv', index=False)
-                    st.success(f"Successfully uploaded {len(new_vouchers)} vouchers")
-            except Exception as e:
-                st.error(f"Error uploading file: {str(e)}")
+            upload = new_upload('voucher_upload', uploaded_vouchers)
+            if upload is not None:
+                try:
+                    new_vouchers = pd.read_csv(
+                        uploaded_vouchers,
+                        usecols=lambda column: column == 'voucher_code',
+                        dtype='string',
+                        keep_default_na=False
+                    )
+                    if 'voucher_code' not in new_vouchers.columns:
+                        upload['error'] = "CSV must contain a 'voucher_code' column"
+                    else:
+                        # Codes such as "NA" are real; only blank cells are skipped.
+                        # Repeated codes are saved once, so count them once too
+                        voucher_codes = new_vouchers['voucher_code']
+                        voucher_codes = voucher_codes[voucher_codes != ''].drop_duplicates()
+                        upload['future'] = get_upload_executor().submit(replace_vouchers, voucher_codes)
+                        upload['clear_caches'] = clear_voucher_caches
+                        upload['message'] = f"Successfully uploaded {len(voucher_codes)} vouchers"
+                except Exception as e:
+                    upload['error'] = f"Error uploading file: {str(e)}"
+            show_upload_status('voucher_upload')
 
     with admin_tab2:
         uploaded_users = st.file_uploader("Upload CSV file with authorized users", type=['csv'], key="user_uploader")
         if uploaded_users is not None:
-            try:
-                new_users = pd.read_csv(uploaded_users)
-                if 'full_name' not in new_users.columns:
-                    st.error("CSV must contain a 'full_name' column")
-                else:
-                    new_users.to_csv('data/authorized_users.csv', index=False)
-                    st.success(f"Successfully uploaded {len(new_users)} authorized users")
-            except Exception as e:
-                st.error(f"Error uploading file: {str(e)}")
+            upload = new_upload('user_upload', uploaded_users)
+            if upload is not None:
+                try:
+                    new_users = pd.read_csv(
+                        uploaded_users,
+                        usecols=lambda column: column == 'full_name',
+                        dtype='string',
+                        keep_default_na=False
+                    )
+                    if 'full_name' not in new_users.columns:
+                        upload['error'] = "CSV must contain a 'full_name' column"
+                    else:
+                        new_users = new_users[new_users['full_name'] != ''].copy()
+                        new_users['full_name_lower'] = new_users['full_name'].str.lower()
+                        upload['future'] = get_upload_executor().submit(replace_authorized_users, new_users)
+                        upload['clear_caches'] = clear_user_caches
+                        upload['message'] = f"Successfully uploaded {len(new_users)} authorized users"
+                except Exception as e:
+                    upload['error'] = f"Error uploading file: {str(e)}"
+            show_upload_status('user_upload')
 
     # Display statistics
     st.markdown("---")
     st.subheader("System Statistics")
     col1, col2 = st.columns(2)
 
-    vouchers_df = load_vouchers()
-    mappings_df = load_mappings()
+    available_vouchers, assigned_vouchers = voucher_counts()
+    total_mappings, recent_mappings = mapping_stats()
     authorized_users_df = load_authorized_users()
 
     with col1:
-        st.metric("Total Vouchers", len(vouchers_df))
-        st.metric("Available Vouchers", len(vouchers_df[vouchers_df['assigned'] == False]))
+        st.metric("Total Vouchers", available_vouchers + assigned_vouchers)
+        st.metric("Available Vouchers", available_vouchers)
         st.metric("Authorized Users", len(authorized_users_df))
 
     with col2:
-        st.metric("Assigned Vouchers", len(vouchers_df[vouchers_df['assigned'] == True]))
-        st.metric("Total Users", len(mappings_df))
+        st.metric("Assigned Vouchers", assigned_vouchers)
+        st.metric("Total Users", total_mappings)
 
     # Recent assignments
-    if len(mappings_df) > 0:
+    if total_mappings > 0:
         st.subheader("Recent Assignments")
-        st.dataframe(
-            mappings_df.tail(5)[['timestamp', 'full_name', 'voucher_code']],
-            hide_index=True
-        )
+        st.dataframe(recent_mappings, hide_index=True)
 
 # User section (always visible)
 if not is_admin:
@@ -0,0 +1,235 @@
+"""Storage and voucher assignment for the captive portal"""
+
+import streamlit as st
+import pandas as pd
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime
+
+DB_PATH = 'data/portal.db'
+SCHEMA_VERSION = 2
+
+def get_db():
+    """Open a connection to the portal database"""
+    # Autocommit mode: transactions are opened explicitly with BEGIN
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
+    # With WAL, commits no longer fsync; the log is synced at checkpoints
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+def read_legacy_csv(path, columns):
+    """Read the given columns of an old CSV data file as strings"""
+    # Like the old CSV loaders, a missing or empty file reads as no rows,
+    # and a missing column reads as blank cells
+    try:
+        data = pd.read_csv(
+            path,
+            usecols=lambda column: column in columns,
+            dtype=str,
+            keep_default_na=False
+        )
+    except (FileNotFoundError, pd.errors.EmptyDataError):
+        data = pd.DataFrame(columns=columns, dtype=str)
+    for column in columns:
+        if column not in data.columns:
+            data[column] = ''
+    return data[columns]
+
+@st.cache_resource
+def init_db():
+    """Create the portal tables, importing the old CSV files on first run"""
+    # Cached as a resource so this runs once per process, not per session
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    with closing(get_db()) as conn:
+        conn.execute('PRAGMA journal_mode=WAL')
+
+        # user_version counts the schema steps that have already been applied;
+        # only take the write lock when one is still pending
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        # Read again under the lock in case another process just migrated
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < 1:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS vouchers (
+                    voucher_code TEXT PRIMARY KEY NOT NULL,
+                    assigned INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            # Holds only unassigned vouchers in rowid order, so the next
+            # voucher to hand out is always the first entry
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS vouchers_available ON vouchers(assigned) WHERE assigned = 0'
+            )
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS mappings (
+                    timestamp TEXT,
+                    full_name TEXT,
+                    voucher_code TEXT
+                )
+            """)
+            # Covers the existing-voucher lookup so it never reads the table
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS mappings_full_name_voucher ON mappings(full_name, voucher_code)'
+            )
+            vouchers = read_legacy_csv('data/vouchers.csv', ['voucher_code', 'assigned'])
+            # Skip blank codes; a blank assigned cell means not assigned
+            vouchers = vouchers[vouchers['voucher_code'] != '']
+            assigned = vouchers['assigned'].str.strip().str.lower() == 'true'
+            conn.executemany(
+                'INSERT OR IGNORE INTO vouchers (voucher_code, assigned) VALUES (?, ?)',
+                zip(vouchers['voucher_code'], assigned.astype(int).tolist())
+            )
+            mappings = read_legacy_csv('data/mappings.csv', ['timestamp', 'full_name', 'voucher_code'])
+            conn.executemany(
+                'INSERT INTO mappings (timestamp, full_name, voucher_code) VALUES (?, ?, ?)',
+                mappings.itertuples(index=False)
+            )
+        if version < 2:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS authorized_users (
+                    full_name TEXT,
+                    full_name_lower TEXT
+                )
+            """)
+            authorized_users = read_legacy_csv('data/authorized_users.csv', ['full_name'])
+            # Skip blank names, as uploads do; older files lack the lowered
+            # column, so it is always derived from the name
+            authorized_users = authorized_users[authorized_users['full_name'] != ''].copy()
+            authorized_users['full_name_lower'] = authorized_users['full_name'].str.lower()
+            conn.executemany(
+                'INSERT INTO authorized_users (full_name, full_name_lower) VALUES (?, ?)',
+                authorized_users[['full_name', 'full_name_lower']].itertuples(index=False)
+            )
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.execute('COMMIT')
+
+@st.cache_data(ttl=None, show_spinner=False)
+def voucher_counts():
+    """Count available and assigned vouchers"""
+    with closing(get_db()) as conn:
+        total, available = conn.execute(
+            """SELECT (SELECT COUNT(*) FROM vouchers),
+                      (SELECT COUNT(*) FROM vouchers WHERE assigned = 0)"""
+        ).fetchone()
+    return available, total - available
+
+@st.cache_data(ttl=None, show_spinner=False)
+def mapping_stats():
+    """Count user-voucher mappings and fetch the five most recent ones"""
+    with closing(get_db()) as conn:
+        total = conn.execute('SELECT COUNT(*) FROM mappings').fetchone()[0]
+        recent = pd.read_sql_query(
+            'SELECT timestamp, full_name, voucher_code FROM mappings ORDER BY rowid DESC LIMIT 5',
+            conn,
+            dtype='string'
+        )
+    # Oldest first, as in the full table
+    return total, recent.iloc[::-1]
+
+@st.cache_data(ttl=None, show_spinner=False)
+def load_authorized_users():
+    """Load authorized users from the database"""
+    with closing(get_db()) as conn:
+        return pd.read_sql_query(
+            'SELECT full_name, full_name_lower FROM authorized_users ORDER BY rowid',
+            conn,
+            dtype='string'
+        )
+
+# A resource, not data: cache_data would unpickle a copy of the set on every call
+@st.cache_resource(show_spinner=False)
+def authorized_token_set():
+    """Build the set of lowercased name parts of all authorized users"""
+    authorized_users = load_authorized_users()
+    return frozenset(authorized_users['full_name_lower'].str.split().explode().dropna())
+
+def is_user_authorized(full_name):
+    """Check if a user is authorized to receive a voucher"""
+    # Authorized if any part of the user's name matches part of an authorized name
+    return not authorized_token_set().isdisjoint(full_name.lower().split())
+
+@st.cache_resource
+def get_upload_executor():
+    """Single background worker that saves admin uploads in order"""
+    return ThreadPoolExecutor(max_workers=1)
+
+def clear_user_caches():
+    """Drop cached authorized user data so the next read sees the database"""
+    load_authorized_users.clear()
+    authorized_token_set.clear()
+
+def clear_voucher_caches():
+    """Drop cached voucher counts so the next read sees the database"""
+    voucher_counts.clear()
+
+def replace_authorized_users(new_users):
+    """Replace the authorized user list"""
+    with closing(get_db()) as conn:
+        conn.execute('BEGIN')
+        conn.execute('DELETE FROM authorized_users')
+        conn.executemany(
+            'INSERT INTO authorized_users (full_name, full_name_lower) VALUES (?, ?)',
+            new_users[['full_name', 'full_name_lower']].itertuples(index=False)
+        )
+        conn.execute('COMMIT')
+    clear_user_caches()
+
+def replace_vouchers(voucher_codes):
+    """Replace the voucher pool with a fresh set of unassigned codes"""
+    with closing(get_db()) as conn:
+        conn.execute('BEGIN')
+        conn.execute('DELETE FROM vouchers')
+        conn.executemany(
+            'INSERT OR IGNORE INTO vouchers (voucher_code, assigned) VALUES (?, 0)',
+            ((voucher_code,) for voucher_code in voucher_codes)
+        )
+        conn.execute('COMMIT')
+    clear_voucher_caches()
+
+def assign_voucher(full_name):
+    """Assign a voucher to a user"""
+    # First check if user is authorized
+    if not is_user_authorized(full_name):
+        return False, "You are not authorized to receive a voucher. Please contact the administrator."
+
+    # Closing the connection rolls back a transaction that was not committed
+    with closing(get_db()) as conn:
+        # Take the write lock up front so concurrent sessions queue here
+        # instead of failing when they try to claim the same voucher
+        conn.execute('BEGIN IMMEDIATE')
+
+        # Check if user already has a voucher
+        existing_mapping = conn.execute(
+            'SELECT voucher_code FROM mappings WHERE full_name = ? ORDER BY rowid LIMIT 1',
+            (full_name,)
+        ).fetchone()
+        if existing_mapping is not None:
+            return True, existing_mapping[0]
+
+        # Mark the first available voucher as assigned
+        assigned_voucher = conn.execute(
+            """UPDATE vouchers SET assigned = 1
+               WHERE rowid = (
+                   SELECT rowid FROM vouchers WHERE assigned = 0 ORDER BY rowid LIMIT 1
+               )
+               RETURNING voucher_code"""
+        ).fetchall()
+        if not assigned_voucher:
+            return False, "No vouchers available"
+        voucher_code = assigned_voucher[0][0]
+
+        # Record the mapping
+        conn.execute(
+            'INSERT INTO mappings (timestamp, full_name, voucher_code) VALUES (?, ?, ?)',
+            (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), full_name, voucher_code)
+        )
+        conn.execute('COMMIT')
+
+    voucher_counts.clear()
+    mapping_stats.clear()
+
+    return True, voucher_code